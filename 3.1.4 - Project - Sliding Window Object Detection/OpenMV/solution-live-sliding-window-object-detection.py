@@ -8,7 +8,7 @@ Date: August 4, 2021
 License: Apache-2.0 (apache.org/licenses/LICENSE-2.0)
 """
 
-import sensor, image, time, tf, math
+import sensor, image, time, tf
 
 # Settings
 model_file = "trained.tflite"           # Location of TFLite model file
@@ -21,6 +21,33 @@ window_width = 48                       # Window width (input to CNN)
 window_height = 48                      # Window height (input to CNN)
 stride = 24                             # How many pixels to move window each step
 pixel_format = sensor.GRAYSCALE         # This model only supports grayscale
+nms_threshold = 0.3                     # Drop boxes that overlap a more probable box by more than this (IoU)
+coarse_threshold = 0.7 * target_threshold   # Also check neighboring windows if coarse window prob. >= this
+
+def iou(a, b):
+    """Intersection over union of two (x, y, w, h, ...) boxes"""
+    iw = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    ih = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    if iw <= 0 or ih <= 0:
+        return 0
+    intersection = iw * ih
+    return intersection / (a[2] * a[3] + b[2] * b[3] - intersection)
+
+def target_prob(img, roi):
+    """Perform inference on the region under a window, return target probability"""
+
+    # Do inference on the region under the window (no need to copy it out first).
+    # OpenMV tf classify returns a list of prediction objects. We should only get one
+    # item in the predictions list, so we extract the output probabilities from that.
+    return net.classify(img, roi=roi)[0].output()[target_idx]
+
+def nms(bboxes, overlap_threshold):
+    """Keep only the most probable box from each group of overlapping boxes"""
+    kept = []
+    for bb in sorted(bboxes, key=lambda b: b[4], reverse=True):
+        if all(iou(bb, k) <= overlap_threshold for k in kept):
+            kept.append(bb)
+    return kept
 
 # Configure camera
 sensor.reset()
@@ -32,13 +59,24 @@ sensor.skip_frames(time = 2000)         # Let the camera adjust
 # Extract labels from labels file
 labels = [line.rstrip('\n').rstrip('\r') for line in open(labels_file)]
 
-# Compute number of window steps
-num_horizontal_windows = math.floor((width - window_width) / stride) + 1
-num_vertical_windows = math.floor((height - window_height) / stride) + 1
+# Compute the x and y location of each window step
+x_coords = list(range(0, width - window_width + 1, stride))
+y_coords = list(range(0, height - window_height + 1, stride))
+
+# Window locations never change, so build the (x, y, w, h) region of each one once
+window_rois = [[(x, y, window_width, window_height) for x in x_coords] for y in y_coords]
+num_rows = len(y_coords)
+num_cols = len(x_coords)
+
+# The coarse pass only looks at every other window in each direction (twice the stride)
+coarse_cells = [(row, col) for row in range(0, num_rows, 2) for col in range(0, num_cols, 2)]
 
 # Find the index of the target label
 target_idx = labels.index(target_label)
 
+# Load the model once (passing the file path to tf.classify reloads it on every call)
+net = tf.load(model_file)
+
 # Start clock (for measureing FPS)
 clock = time.clock()
 
@@ -57,26 +95,26 @@ while(True):
     # image, compare output to threshould, print out info (x, y, w, h) of all bounding boxes
     # that meet or exceed that threshold
 
-    # Slide window across image and perform inference on each sub-image
-    bboxes = []
-    for vertical_window in range(num_vertical_windows):
-        for horizontal_window in range(num_horizontal_windows):
-
-            # Crop out image under window
-            x = horizontal_window * stride
-            y = vertical_window * stride
-            window_img = img.copy(roi=(x, y, window_width, window_height))
+    # Coarse pass: slide window across image at twice the stride
+    probs = {}
+    for row, col in coarse_cells:
+        probs[(row, col)] = target_prob(img, window_rois[row][col])
 
-            # Do inference. OpenMV tf classify returns a list of prediction objects.
-            objs = tf.classify(model_file, window_img)
+    # Fine pass: check the neighbors (at the normal stride) of any coarse window that
+    # might contain the target
+    for row, col in coarse_cells:
+        if probs[(row, col)] >= coarse_threshold:
+            for r in range(max(row - 1, 0), min(row + 2, num_rows)):
+                for c in range(max(col - 1, 0), min(col + 2, num_cols)):
+                    if (r, c) not in probs:
+                        probs[(r, c)] = target_prob(img, window_rois[r][c])
 
-            # We should only get one item in the predictions list, so we extract the
-            # output probabilities from that.
-            predictions = objs[0].output()
+    # Remember bounding box locations if target inference probability is over threshold
+    bboxes = [window_rois[row][col] + (prob,)
+                for (row, col), prob in probs.items() if prob >= target_threshold]
 
-            # Remember bounding box location if target inference probability is over threshold
-            if predictions[target_idx] >= target_threshold:
-                bboxes.append((x, y, window_width, window_height, predictions[target_idx]))
+    # Remove duplicate detections of the same object
+    bboxes = nms(bboxes, nms_threshold)
 
     # Draw bounding boxes on preview image
     for bb in bboxes:
@@ -86,6 +124,5 @@ while(True):
     print("---")
     print("Boxes:")
     for bb in bboxes:
-        print(" " + "x:" + str(bb[0]) + " y:" + str(bb[1]) + " w:" + str(bb[2]) +
-                " h:" + str(bb[3]) + " prob:" + str(bb[4]))
+        print(" x:%d y:%d w:%d h:%d prob:%.3f" % bb)
     print("FPS:", clock.fps())
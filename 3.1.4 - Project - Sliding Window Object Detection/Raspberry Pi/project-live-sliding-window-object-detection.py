@@ -11,53 +11,195 @@ License: Apache-2.0 (apache.org/licenses/LICENSE-2.0)
 """
 
 import os, sys, time, math
+import signal
+import threading
+from queue import Queue, Empty
 import cv2
+import numpy as np
 from picamera import PiCamera
-from picamera.array import PiRGBArray
-from edge_impulse_linux.image import ImageImpulseRunner
+import tflite_runtime.interpreter as tflite
 
 # Settings
-model_file = "modelfile.eim"            # Trained ML model from Edge Impulse
+model_file = "trained.tflite"           # Trained ML model from Edge Impulse
+labels_file = "labels.txt"              # Labels for the model (one per line)
+num_threads = 2                         # Inference threads (1 per core below)
+cpu_cores = {2, 3}                      # Cores to run on (isolcpus=2,3 in cmdline)
+delegate_file = ""                      # Extra TFLite delegate lib (optional)
 target_label = "dog"                    # Which label we're looking for
 target_threshold = 0.6                  # Draw box if output prob. >= this value
 cam_width = 320                         # Width of frame (pixels)
 cam_height = 240                        # Height of frame (pixels)
 rotation = 0                            # Camera rotation (0, 90, 180, or 270)
+display = "window"                      # "window", "kms" (no desktop), "none"
 window_width = 96                       # Window width (input to CNN)
 window_height = 96                      # Window height (input to CNN)
 stride = 24                             # How many pixels to move the window
 
-# The ImpulseRunner module will attempt to load files relative to its location,
-# so we make it load files relative to this program instead
+def capture_frames(camera, free, latest, stop):
+    """Continuously capture frames, keeping only the newest one in the queue"""
+    
+    def outputs():
+        """Hand picamera free buffers to fill, queueing each one once filled"""
+        while not stop.is_set():
+            buf = free.get()
+            yield buf
+            
+            # picamera only asks for the next buffer once this one is filled.
+            # Recycle the previous frame if it has not been picked up yet.
+            try:
+                free.put(latest.get_nowait())
+            except Empty:
+                pass
+            latest.put(buf)
+            
+    # Capture straight into the Numpy arrays (no per-frame allocation)
+    camera.capture_sequence(outputs(), format='rgb', use_video_port=True)
+
+def load_interpreter(input_shape=None):
+    """Load the model, with its input resized to input_shape if given"""
+    
+    # XNNPACK (NEON) kernels are built into tflite-runtime >= 2.13, but an 
+    # external delegate library can be loaded as well
+    delegates = []
+    if delegate_file:
+        delegates.append(tflite.load_delegate(delegate_file))
+    interpreter = tflite.Interpreter(model_path=model_path, 
+                                     experimental_delegates=delegates, 
+                                     num_threads=num_threads)
+    if input_shape is not None:
+        interpreter.resize_tensor_input(input_details['index'], input_shape)
+    interpreter.allocate_tensors()
+    return interpreter
+
+def classify(windows):
+    """Perform inference on a batch of window images, return output probs."""
+    
+    # Split batches that are too big for the model into several runs
+    if len(windows) > batch_sizes[-1]:
+        step = batch_sizes[-1]
+        return np.concatenate([classify(windows[i:(i + step)]) 
+                               for i in range(0, len(windows), step)])
+    
+    # Use the smallest preallocated batch that fits (the rest is padding)
+    n = len(windows)
+    size = next(size for size in batch_sizes if size >= n)
+    interpreter = interpreters[size]
+    data = inputs[size]
+    
+    # Scale pixels to 0..1 (and quantize them if the model expects integers)
+    if input_details['dtype'] == np.float32:
+        np.multiply(windows, 1 / 255.0, out=data[:n], dtype=np.float32)
+    else:
+        scale, zero_point = input_details['quantization']
+        limits = np.iinfo(input_details['dtype'])
+        data[:n] = np.clip(np.rint(windows / (255.0 * scale) + zero_point), 
+                           limits.min, 
+                           limits.max)
+    
+    # Perform inference on the whole batch at once
+    interpreter.set_tensor(input_details['index'], data)
+    interpreter.invoke()
+    output = interpreter.get_tensor(output_details['index'])[:n]
+    
+    # Convert quantized outputs back to probabilities
+    if output_details['dtype'] != np.float32:
+        scale, zero_point = output_details['quantization']
+        output = (output.astype(np.float32) - zero_point) * scale
+        
+    return output
+
+# Run on dedicated cores with a higher priority to reduce frame time jitter
+# (raising the priority needs root, so carry on without it otherwise). Cores
+# set aside with isolcpus are left out of our default affinity, so check the 
+# cores against every online CPU instead.
+cores = cpu_cores & set(range(os.cpu_count()))
+if cores:
+    os.sched_setaffinity(0, cores)
+else:
+    print("WARNING: Could not run on cores", cpu_cores, "(not available)")
+try:
+    os.nice(-10)
+except PermissionError:
+    print("WARNING: Could not raise priority (run with sudo to do so)")
+
+# Load files relative to this program (instead of the current directory)
 dir_path = os.path.dirname(os.path.realpath(__file__))
 model_path = os.path.join(dir_path, model_file)
+labels_path = os.path.join(dir_path, labels_file)
 
-# Load the model file
-runner = ImageImpulseRunner(model_path)
-
-# Initialize model (and print information if it loads)
+# Load the model (to find its input and output format) and read the labels
 try:
-    model_info = runner.init()
-    labels = model_info['model_parameters']['labels']
-    print("Model name:", model_info['project']['name'])
-    print("Model owner:", model_info['project']['owner'])
+    interpreter = load_interpreter()
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    labels = [line.rstrip('\n').rstrip('\r') for line in open(labels_path)]
+    print("Model input:", input_details['shape'], input_details['dtype'])
     print("Labels:", labels)
     
 # Exit if we cannot initialize the model
 except Exception as e:
     print("ERROR: Could not initialize model")
     print("Exception:", e)
-    if (runner):
-            runner.stop()
     sys.exit(1)
 
+# Models trained on grayscale images take 1 channel per pixel instead of 3
+channels = input_details['shape'][3]
+
 # Compute number of window steps
 num_horizontal_windows = math.floor((cam_width - window_width) / stride) + 1
 num_vertical_windows = math.floor((cam_height - window_height) / stride) + 1
 
+# Size the model input and allocate its tensors only once for each of a few
+# batch sizes (one interpreter per size), so nothing is resized while running.
+# Powers of 2 keep the padding small. The interpreter loaded above is reused 
+# for the model's own batch size.
+max_windows = num_horizontal_windows * num_vertical_windows
+batch_sizes = sorted({size for size in (1, 2, 4, 8, 16, 32) 
+                      if size < max_windows} | {max_windows})
+try:
+    interpreters = {size: (interpreter if size == input_details['shape'][0] 
+                           else load_interpreter([size, 
+                                                  window_height, 
+                                                  window_width, 
+                                                  channels])) 
+                    for size in batch_sizes}
+    
+# Some models have their batch size built in (e.g. in a reshape), so run 
+# those on as many windows at a time as they were made for
+except Exception as e:
+    print("WARNING: Model does not support other batch sizes")
+    print("Exception:", e)
+    batch_sizes = [input_details['shape'][0]]
+    interpreters = {batch_sizes[0]: interpreter}
+
+# Preallocated (float or quantized) model input for each batch size
+inputs = {size: np.zeros((size, window_height, window_width, channels), 
+                         dtype=input_details['dtype']) 
+          for size in batch_sizes}
+
 # Initial framerate value
 fps = 0
 
+# Press ctrl+c to quit (this also works when there is no preview window)
+running = True
+def stop_running(signum, frame):
+    global running
+    running = False
+signal.signal(signal.SIGINT, stop_running)
+
+# Without a desktop, send frames straight to the screen with GStreamer's 
+# kmssink instead of going through X11 with cv2.imshow()
+if display == "kms":
+    writer = cv2.VideoWriter("appsrc ! videoconvert ! kmssink sync=false", 
+                             cv2.CAP_GSTREAMER, 
+                             0, 
+                             30, 
+                             (cam_width, cam_height), 
+                             True)
+    if not writer.isOpened():
+        print("ERROR: Could not open kmssink (is OpenCV built with GStreamer?)")
+        sys.exit(1)
+
 # Start the camera
 with PiCamera() as camera:
     
@@ -65,22 +207,32 @@ with PiCamera() as camera:
     camera.resolution = (cam_width, cam_height)
     camera.rotation = rotation
     
-    # Container for our frames
-    raw_capture = PiRGBArray(camera, size=(cam_width, cam_height))
-
-    # Continuously capture frames (this acts as our main "while True" loop)
-    for frame in camera.capture_continuous(raw_capture, 
-                                            format='bgr', 
-                                            use_video_port=True):
-                                            
-        # Get timestamp for calculating actual framerate
-        timestamp = cv2.getTickCount()
+    # Preallocated frame buffers that get reused once we are done with them:
+    # 1 being captured, 1 waiting in the queue, and 1 being processed
+    free = Queue()
+    for _ in range(3):
+        free.put(np.empty((cam_height, cam_width, 3), dtype=np.uint8))
+
+    # Capture frames in the background so we always work on the newest one
+    latest = Queue(maxsize=1)
+    stop_capture = threading.Event()
+    capture_thread = threading.Thread(target=capture_frames, 
+                                      args=(camera, free, latest, stop_capture), 
+                                      daemon=True)
+    capture_thread.start()
+
+    # Main while loop
+    while running:
         
-        # Get Numpy array that represents the image
-        img = frame.array
+        # Wait for the newest frame (Numpy array already in RGB order). Time 
+        # out now and then to check whether we have been asked to stop.
+        try:
+            img = latest.get(timeout=0.5)
+        except Empty:
+            continue
         
-        # Convert image to RGB
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        # Get timestamp for calculating actual framerate
+        timestamp = cv2.getTickCount()
         
         # >>> ENTER YOUR CODE HERE <<<
         # Loop over all possible windows, crop/copy image under window, 
@@ -88,19 +240,30 @@ with PiCamera() as camera:
         # print out info (x, y, w, h) of all bounding boxes that meet or exceed 
         # that threshold.
         
-        # Show the frame
-        cv2.imshow("Frame", img)
+        # Show the frame (OpenCV expects BGR, so use a channel-reversed view)
+        if display == "window":
+            cv2.imshow("Frame", img[:, :, ::-1])
+        elif display == "kms":
+            writer.write(img[:, :, ::-1])
         
-        # Clear the stream to prepare for next frame
-        raw_capture.truncate(0)
+        # Hand the frame buffer back to the capture thread for reuse
+        free.put(img)
         
         # Calculate framrate
         frame_time = (cv2.getTickCount() - timestamp) / cv2.getTickFrequency()
         fps = 1 / frame_time
         
-        # Press 'q' to quit
-        if cv2.waitKey(1) == ord('q'):
+        # Press 'q' in the preview window to quit
+        if display == "window" and cv2.waitKey(1) == ord('q'):
             break
+    
+    # Stop the capture thread before the camera is closed
+    # (don't wait long, in case one is stuck on the camera or the model)
+    stop_capture.set()
+    capture_thread.join(timeout=1)
         
 # Clean up
-cv2.destroyAllWindows()
\ No newline at end of file
+if display == "window":
+    cv2.destroyAllWindows()
+elif display == "kms":
+    writer.release()
\ No newline at end of file
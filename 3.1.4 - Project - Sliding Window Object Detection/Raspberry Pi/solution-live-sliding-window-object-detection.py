@@ -10,54 +10,266 @@ Date: August 5, 2021
 License: Apache-2.0 (apache.org/licenses/LICENSE-2.0)
 """
 
-import os, sys, time, math
+import os, sys, time
+import signal
+import threading
+from queue import Queue, Empty
 import cv2
+import numpy as np
 from picamera import PiCamera
-from picamera.array import PiRGBArray
-from edge_impulse_linux.image import ImageImpulseRunner
+import tflite_runtime.interpreter as tflite
 
 # Settings
-model_file = "modelfile.eim"            # Trained ML model from Edge Impulse
+model_file = "trained.tflite"           # Trained ML model from Edge Impulse
+labels_file = "labels.txt"              # Labels for the model (one per line)
+num_threads = 2                         # Inference threads (1 per core below)
+cpu_cores = {2, 3}                      # Cores to run on (isolcpus=2,3 in cmdline)
+delegate_file = ""                      # Extra TFLite delegate lib (optional)
 target_label = "dog"                    # Which label we're looking for
 target_threshold = 0.6                  # Draw box if output prob. >= this value
 cam_width = 320                         # Width of frame (pixels)
 cam_height = 240                        # Height of frame (pixels)
 rotation = 0                            # Camera rotation (0, 90, 180, or 270)
+display = "window"                      # "window", "kms" (no desktop), "none"
 window_width = 96                       # Window width (input to CNN)
 window_height = 96                      # Window height (input to CNN)
 stride = 24                             # How many pixels to move the window
+nms_threshold = 0.3                     # Drop boxes that overlap more (IoU)
+coarse_threshold = 0.7 * target_threshold   # Check nearby if coarse prob >= this
+motion_threshold = 4                    # Redo inference if window changes more
+background_rate = 0.05                  # How quickly background adapts (0..1)
+max_cache_age = 30                      # Redo inference after this many frames
 
-# The ImpulseRunner module will attempt to load files relative to its location,
-# so we make it load files relative to this program instead
+def capture_frames(camera, free, latest, stop):
+    """Continuously capture frames, keeping only the newest one in the queue"""
+    
+    def outputs():
+        """Hand picamera free buffers to fill, queueing each one once filled"""
+        while not stop.is_set():
+            buf = free.get()
+            yield buf
+            
+            # picamera only asks for the next buffer once this one is filled.
+            # Recycle the previous frame if it has not been picked up yet.
+            try:
+                free.put(latest.get_nowait())
+            except Empty:
+                pass
+            latest.put(buf)
+            
+    # Capture straight into the Numpy arrays (no per-frame allocation)
+    camera.capture_sequence(outputs(), format='rgb', use_video_port=True)
+
+def load_interpreter(input_shape=None):
+    """Load the model, with its input resized to input_shape if given"""
+    
+    # XNNPACK (NEON) kernels are built into tflite-runtime >= 2.13, but an 
+    # external delegate library can be loaded as well
+    delegates = []
+    if delegate_file:
+        delegates.append(tflite.load_delegate(delegate_file))
+    interpreter = tflite.Interpreter(model_path=model_path, 
+                                     experimental_delegates=delegates, 
+                                     num_threads=num_threads)
+    if input_shape is not None:
+        interpreter.resize_tensor_input(input_details['index'], input_shape)
+    interpreter.allocate_tensors()
+    return interpreter
+
+def classify(windows):
+    """Perform inference on a batch of window images, return output probs."""
+    
+    # Split batches that are too big for the model into several runs
+    if len(windows) > batch_sizes[-1]:
+        step = batch_sizes[-1]
+        return np.concatenate([classify(windows[i:(i + step)]) 
+                               for i in range(0, len(windows), step)])
+    
+    # Use the smallest preallocated batch that fits (the rest is padding)
+    n = len(windows)
+    size = next(size for size in batch_sizes if size >= n)
+    interpreter = interpreters[size]
+    data = inputs[size]
+    
+    # Scale pixels to 0..1 (and quantize them if the model expects integers)
+    if input_details['dtype'] == np.float32:
+        np.multiply(windows, 1 / 255.0, out=data[:n], dtype=np.float32)
+    else:
+        scale, zero_point = input_details['quantization']
+        limits = np.iinfo(input_details['dtype'])
+        data[:n] = np.clip(np.rint(windows / (255.0 * scale) + zero_point), 
+                           limits.min, 
+                           limits.max)
+    
+    # Perform inference on the whole batch at once
+    interpreter.set_tensor(input_details['index'], data)
+    interpreter.invoke()
+    output = interpreter.get_tensor(output_details['index'])[:n]
+    
+    # Convert quantized outputs back to probabilities
+    if output_details['dtype'] != np.float32:
+        scale, zero_point = output_details['quantization']
+        output = (output.astype(np.float32) - zero_point) * scale
+        
+    return output
+
+# Run on dedicated cores with a higher priority to reduce frame time jitter
+# (raising the priority needs root, so carry on without it otherwise). Cores
+# set aside with isolcpus are left out of our default affinity, so check the 
+# cores against every online CPU instead.
+cores = cpu_cores & set(range(os.cpu_count()))
+if cores:
+    os.sched_setaffinity(0, cores)
+else:
+    print("WARNING: Could not run on cores", cpu_cores, "(not available)")
+try:
+    os.nice(-10)
+except PermissionError:
+    print("WARNING: Could not raise priority (run with sudo to do so)")
+
+# Load files relative to this program (instead of the current directory)
 dir_path = os.path.dirname(os.path.realpath(__file__))
 model_path = os.path.join(dir_path, model_file)
+labels_path = os.path.join(dir_path, labels_file)
 
-# Load the model file
-runner = ImageImpulseRunner(model_path)
-
-# Initialize model (and print information if it loads)
+# Load the model (to find its input and output format) and read the labels
 try:
-    model_info = runner.init()
-    labels = model_info['model_parameters']['labels']
-    print("Model name:", model_info['project']['name'])
-    print("Model owner:", model_info['project']['owner'])
+    interpreter = load_interpreter()
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    labels = [line.rstrip('\n').rstrip('\r') for line in open(labels_path)]
+    print("Model input:", input_details['shape'], input_details['dtype'])
     print("Labels:", labels)
     
 # Exit if we cannot initialize the model
 except Exception as e:
     print("ERROR: Could not initialize model")
     print("Exception:", e)
-    if (runner):
-            runner.stop()
     sys.exit(1)
 
-# Compute number of window steps
-num_horizontal_windows = math.floor((cam_width - window_width) / stride) + 1
-num_vertical_windows = math.floor((cam_height - window_height) / stride) + 1
+# Models trained on grayscale images take 1 channel per pixel instead of 3
+channels = input_details['shape'][3]
+
+# Find the index of the target label
+target_idx = labels.index(target_label)
+
+# Compute the x and y location of each window step
+x_coords = list(range(0, cam_width - window_width + 1, stride))
+y_coords = list(range(0, cam_height - window_height + 1, stride))
+
+# Window locations never change, so compute the top-left corner of each once
+offsets = np.array([(x, y) for y in y_coords for x in x_coords], dtype=np.int32)
+
+# Index of each window in a (row, col) grid. The coarse pass only looks at 
+# every other window in each direction (twice the stride).
+grid = np.arange(len(offsets)).reshape(len(y_coords), len(x_coords))
+coarse_idxs = grid[::2, ::2].flatten()
+
+# Size the model input and allocate its tensors only once for each of a few
+# batch sizes (one interpreter per size), so nothing is resized while running.
+# Powers of 2 keep the padding small, and the coarse pass gets its own size.
+# The interpreter loaded above is reused for the model's own batch size.
+max_windows = len(offsets)
+batch_sizes = sorted({size for size in (1, 2, 4, 8, 16, 32) 
+                      if size < max_windows} | {len(coarse_idxs), max_windows})
+try:
+    interpreters = {size: (interpreter if size == input_details['shape'][0] 
+                           else load_interpreter([size, 
+                                                  window_height, 
+                                                  window_width, 
+                                                  channels])) 
+                    for size in batch_sizes}
+    
+# Some models have their batch size built in (e.g. in a reshape), so run 
+# those on as many windows at a time as they were made for
+except Exception as e:
+    print("WARNING: Model does not support other batch sizes")
+    print("Exception:", e)
+    batch_sizes = [input_details['shape'][0]]
+    interpreters = {batch_sizes[0]: interpreter}
+
+# Preallocated (float or quantized) model input for each batch size
+inputs = {size: np.zeros((size, window_height, window_width, channels), 
+                         dtype=input_details['dtype']) 
+          for size in batch_sizes}
+
+# Bounding box (x, y, w, h) of each window
+window_rects = np.column_stack((offsets, 
+                                np.full(len(offsets), window_width), 
+                                np.full(len(offsets), window_height)))
+
+# Contiguous buffer (reused every frame) that the window crops are packed into
+batch = np.empty((len(offsets), window_height, window_width, channels), 
+                 dtype=np.uint8)
+
+# Last output probabilities of each window (reused while the window is static)
+probs = np.zeros((len(offsets), len(labels)), dtype=np.float32)
+probs_valid = np.zeros(len(offsets), dtype=bool)
+
+# Running average of the scene, used to find windows that have changed
+background = None
+
+# Frames processed so far (used to take turns expiring cached results)
+frame_count = 0
+
+def batch_cost(n):
+    """Number of windows (padding included) the model runs to classify n"""
+    full, rest = divmod(n, batch_sizes[-1])
+    cost = full * batch_sizes[-1]
+    if rest:
+        cost += next(size for size in batch_sizes if size >= rest)
+    return cost
+
+def neighbor_idxs():
+    """Find the windows around any coarse window that might contain the target"""
+    coarse_hits = probs[grid[::2, ::2], target_idx] >= coarse_threshold
+    neighbors = np.zeros(grid.shape, dtype=bool)
+    for row, col in np.argwhere(coarse_hits) * 2:
+        neighbors[max(row - 1, 0):(row + 2), max(col - 1, 0):(col + 2)] = True
+    return grid[neighbors]
+
+def update_windows(idxs, src):
+    """Perform inference on the given windows that have no valid result yet"""
+    idxs = idxs[~probs_valid[idxs]]
+    if idxs.size == 0:
+        return
+    
+    # Pack windows that need inference into the front of the batch buffer
+    for j, i in enumerate(idxs):
+        x, y = offsets[i]
+        batch[j] = src[y:(y + window_height), x:(x + window_width)]
+    
+    # Perform inference on all of those sub-images (windows) in one batch
+    try:
+        probs[idxs] = classify(batch[:idxs.size])
+        probs_valid[idxs] = True
+    except Exception as e:
+        print("ERROR: Could not perform inference")
+        print("Exception:", e)
 
 # Initial framerate value
 fps = 0
 
+# Press ctrl+c to quit (this also works when there is no preview window)
+running = True
+def stop_running(signum, frame):
+    global running
+    running = False
+signal.signal(signal.SIGINT, stop_running)
+
+# Without a desktop, send frames straight to the screen with GStreamer's 
+# kmssink instead of going through X11 with cv2.imshow()
+if display == "kms":
+    writer = cv2.VideoWriter("appsrc ! videoconvert ! kmssink sync=false", 
+                             cv2.CAP_GSTREAMER, 
+                             0, 
+                             30, 
+                             (cam_width, cam_height), 
+                             True)
+    if not writer.isOpened():
+        print("ERROR: Could not open kmssink (is OpenCV built with GStreamer?)")
+        sys.exit(1)
+
 # Start the camera
 with PiCamera() as camera:
     
@@ -65,22 +277,32 @@ with PiCamera() as camera:
     camera.resolution = (cam_width, cam_height)
     camera.rotation = rotation
     
-    # Container for our frames
-    raw_capture = PiRGBArray(camera, size=(cam_width, cam_height))
-
-    # Continuously capture frames (this acts as our main "while True" loop)
-    for frame in camera.capture_continuous(raw_capture, 
-                                            format='bgr', 
-                                            use_video_port=True):
-                                            
-        # Get timestamp for calculating actual framerate
-        timestamp = cv2.getTickCount()
+    # Preallocated frame buffers that get reused once we are done with them:
+    # 1 being captured, 1 waiting in the queue, and 1 being processed
+    free = Queue()
+    for _ in range(3):
+        free.put(np.empty((cam_height, cam_width, 3), dtype=np.uint8))
+
+    # Capture frames in the background so we always work on the newest one
+    latest = Queue(maxsize=1)
+    stop_capture = threading.Event()
+    capture_thread = threading.Thread(target=capture_frames, 
+                                      args=(camera, free, latest, stop_capture), 
+                                      daemon=True)
+    capture_thread.start()
+
+    # Main while loop
+    while running:
         
-        # Get Numpy array that represents the image
-        img = frame.array
+        # Wait for the newest frame (Numpy array already in RGB order). Time 
+        # out now and then to check whether we have been asked to stop.
+        try:
+            img = latest.get(timeout=0.5)
+        except Empty:
+            continue
         
-        # Convert image to RGB
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        # Get timestamp for calculating actual framerate
+        timestamp = cv2.getTickCount()
         
         # >>> ENTER YOUR CODE HERE <<<
         # Loop over all possible windows, crop/copy image under window, 
@@ -88,37 +310,67 @@ with PiCamera() as camera:
         # print out info (x, y, w, h) of all bounding boxes that meet or exceed 
         # that threshold.
         
-        # Slide window across image and perform inference on each sub-image
-        bboxes = []
-        for vertical_window in range(num_vertical_windows):
-            for horizontal_window in range(num_horizontal_windows):
-
-                # Crop out image under window
-                x = horizontal_window * stride
-                y = vertical_window * stride
-                window_img = img[y:(y + window_height), x:(x + window_width)]
-                
-                # Extract features from image (e.g. convert to grayscale, crop, etc.)
-                features, cropped = runner.get_features_from_image(window_img)
-
-                # Do inference on sub-image (cropped window portion)
-                res = None
-                try:
-                    res = runner.classify(features)
-                except Exception as e:
-                    print("ERROR: Could not perform inference")
-                    print("Exception:", e)
-                
-                # The output probabilities are stored in the results
-                predictions = res['result']['classification']
-                
-                # Remember bounding box location if target inference >= thresh.
-                if predictions[target_label] >= target_threshold:
-                    bboxes.append((x, 
-                                   y, 
-                                   window_width, 
-                                   window_height, 
-                                   predictions[target_label]))
+        # Compare frame to the background to see how much each window changed
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        if background is None:
+            background = gray.astype(np.float32)
+        cv2.accumulateWeighted(gray, background, background_rate)
+        diff = cv2.absdiff(gray, cv2.convertScaleAbs(background))
+        
+        # Sum the differences under every window at once with an integral image
+        sums = cv2.integral(diff)
+        xs = offsets[:, 0]
+        ys = offsets[:, 1]
+        window_diffs = (sums[ys + window_height, xs + window_width] - 
+                        sums[ys, xs + window_width] - 
+                        sums[ys + window_height, xs] + 
+                        sums[ys, xs])
+        moving = window_diffs >= motion_threshold * window_width * window_height
+        
+        # Only redo inference on windows that moved (or have no result yet)
+        probs_valid &= ~moving
+        
+        # Slow changes may never count as motion, so also expire a few windows
+        # each frame (in turn) so that no result is older than max_cache_age
+        probs_valid[(frame_count % max_cache_age)::max_cache_age] = False
+        frame_count += 1
+        
+        # Grayscale models use the grayscale frame (a third of the data)
+        src = gray[:, :, np.newaxis] if channels == 1 else img
+        
+        # Going by the current results, a coarse and a fine pass could cost 
+        # more than one pass over every window (e.g. when a lot is moving). 
+        # If so, just do that single pass instead.
+        pending = ~probs_valid
+        if (batch_cost(np.count_nonzero(pending[coarse_idxs])) + 
+                batch_cost(np.count_nonzero(pending[neighbor_idxs()])) > 
+                batch_cost(np.count_nonzero(pending))):
+            update_windows(grid.flatten(), src)
+        else:
+            
+            # Coarse pass: slide window across image at twice the stride
+            update_windows(coarse_idxs, src)
+            
+            # Fine pass: check the neighbors (at the normal stride) of any 
+            # coarse window that might contain the target
+            update_windows(neighbor_idxs(), src)
+
+        # Only keep bounding box locations where target inference >= thresh.
+        keep = probs_valid & (probs[:, target_idx] >= target_threshold)
+        rects = window_rects[keep]
+        scores = probs[keep, target_idx]
+
+        # Remove duplicate detections (keep most probable of overlapping boxes)
+        if len(rects) > 0:
+            idxs = cv2.dnn.NMSBoxes(rects.tolist(), 
+                                    scores.tolist(), 
+                                    0.0, 
+                                    nms_threshold)
+            idxs = np.array(idxs, dtype=np.int32).flatten()
+            rects = rects[idxs]
+            scores = scores[idxs]
+        bboxes = [tuple(rect) + (score,) 
+                  for rect, score in zip(rects.tolist(), scores.tolist())]
 
         # Draw bounding boxes on preview image
         for bb in bboxes:
@@ -131,23 +383,33 @@ with PiCamera() as camera:
         print("---")
         print("Boxes:")
         for bb in bboxes:
-            print(" " + "x:" + str(bb[0]) + " y:" + str(bb[1]) + " w:" + str(bb[2]) +
-                    " h:" + str(bb[3]) + " prob:" + str(bb[4]))
+            print(" x:%d y:%d w:%d h:%d prob:%.3f" % bb)
         print("FPS:", round(fps, 2))
         
-        # Show the frame
-        cv2.imshow("Frame", img)
+        # Show the frame (OpenCV expects BGR, so use a channel-reversed view)
+        if display == "window":
+            cv2.imshow("Frame", img[:, :, ::-1])
+        elif display == "kms":
+            writer.write(img[:, :, ::-1])
         
-        # Clear the stream to prepare for next frame
-        raw_capture.truncate(0)
+        # Hand the frame buffer back to the capture thread for reuse
+        free.put(img)
         
         # Calculate framrate
         frame_time = (cv2.getTickCount() - timestamp) / cv2.getTickFrequency()
         fps = 1 / frame_time
         
-        # Press 'q' to quit
-        if cv2.waitKey(1) == ord('q'):
+        # Press 'q' in the preview window to quit
+        if display == "window" and cv2.waitKey(1) == ord('q'):
             break
+    
+    # Stop the capture thread before the camera is closed
+    # (don't wait long, in case one is stuck on the camera or the model)
+    stop_capture.set()
+    capture_thread.join(timeout=1)
         
 # Clean up
-cv2.destroyAllWindows()
\ No newline at end of file
+if display == "window":
+    cv2.destroyAllWindows()
+elif display == "kms":
+    writer.release()
\ No newline at end of file
@@ -12,9 +12,12 @@ License: Apache-2.0 (apache.org/licenses/LICENSE-2.0)
 """
 
 import os, sys, time
+import signal
+import threading
+from queue import Queue, Empty, Full
 import cv2
+import numpy as np
 from picamera import PiCamera
-from picamera.array import PiRGBArray
 from edge_impulse_linux.image import ImageImpulseRunner
 
 # Settings
@@ -22,6 +25,59 @@ model_file = "modelfile.eim"             # Trained ML model from Edge Impulse
 res_width = 320                          # Resolution of camera (width)
 res_height = 320                         # Resolution of camera (height)
 rotation = 0                            # Camera rotation (0, 90, 180, or 270)
+display = "window"                      # "window" (desktop), "kms" (no desktop), or "none"
+cpu_cores = {2, 3}                      # Cores to run the model on (isolcpus=2,3 in /boot/cmdline.txt)
+
+def capture_frames(camera, free, latest, stop):
+    """Continuously capture frames, keeping only the newest one in the queue"""
+    
+    def outputs():
+        """Hand picamera free buffers to fill, queueing each one once filled"""
+        while not stop.is_set():
+            buf = free.get()
+            yield buf
+            
+            # picamera only asks for the next buffer once this one is filled.
+            # Recycle the previous frame if it has not been picked up yet.
+            try:
+                free.put(latest.get_nowait())
+            except Empty:
+                pass
+            latest.put(buf)
+            
+    # Capture straight into the Numpy arrays (no per-frame allocation)
+    camera.capture_sequence(outputs(), format='rgb', use_video_port=True)
+
+def infer_frames(runner, free, latest, results, stop):
+    """Perform inference on the newest frames and pass them on for display"""
+    while not stop.is_set():
+        
+        # Wait for the newest frame (Numpy array already in RGB order)
+        try:
+            img = latest.get(timeout=0.5)
+        except Empty:
+            continue
+        
+        # Encapsulate raw values into array for model input and perform 
+        # inference (skip the frame and reuse its buffer if either fails)
+        try:
+            features, cropped = runner.get_features_from_image(img)
+            res = runner.classify(features)
+        except Exception as e:
+            print("ERROR: Could not perform inference")
+            print("Exception:", e)
+            res = None
+        if res is None:
+            free.put(img)
+            continue
+            
+        # Hand frame and results to the display loop (unless we are stopping)
+        while not stop.is_set():
+            try:
+                results.put((img, res), timeout=0.5)
+                break
+            except Full:
+                pass
 
 # The ImpulseRunner module will attempt to load files relative to its location,
 # so we make it load files relative to this program instead
@@ -45,9 +101,49 @@ except Exception as e:
             runner.stop()
     sys.exit(1)
 
+# The .eim model process (started by the runner) does the inference, so run 
+# all of its threads on the dedicated cores with a higher priority to reduce 
+# frame time jitter. Capture and display stay on the other cores. Raising the
+# priority needs root, so carry on without it otherwise.
+cores = cpu_cores & set(range(os.cpu_count()))
+model_pid = runner._runner.pid
+model_tids = [int(tid) for tid in os.listdir("/proc/%d/task" % model_pid)]
+if cores:
+    for tid in model_tids:
+        os.sched_setaffinity(tid, cores)
+    if os.sched_getaffinity(0) - cores:
+        os.sched_setaffinity(0, os.sched_getaffinity(0) - cores)
+else:
+    print("WARNING: Could not run on cores", cpu_cores, "(not available)")
+try:
+    for tid in model_tids:
+        os.setpriority(os.PRIO_PROCESS, tid, -10)
+except PermissionError:
+    print("WARNING: Could not raise priority (run with sudo to do so)")
+
 # Initial framerate value
 fps = 0
 
+# Press ctrl+c to quit (this also works when there is no preview window)
+running = True
+def stop_running(signum, frame):
+    global running
+    running = False
+signal.signal(signal.SIGINT, stop_running)
+
+# Without a desktop, send frames straight to the screen with GStreamer's 
+# kmssink instead of going through X11 with cv2.imshow()
+if display == "kms":
+    writer = cv2.VideoWriter("appsrc ! videoconvert ! kmssink sync=false", 
+                             cv2.CAP_GSTREAMER, 
+                             0, 
+                             30, 
+                             (res_width, res_height), 
+                             True)
+    if not writer.isOpened():
+        print("ERROR: Could not open kmssink (is OpenCV built with GStreamer?)")
+        sys.exit(1)
+
 # Start the camera
 with PiCamera() as camera:
     
@@ -55,32 +151,41 @@ with PiCamera() as camera:
     camera.resolution = (res_width, res_height)
     camera.rotation = rotation
     
-    # Container for our frames
-    raw_capture = PiRGBArray(camera, size=(res_width, res_height))
-
-    # Continuously capture frames (this is our while loop)
-    for frame in camera.capture_continuous(raw_capture, 
-                                            format='bgr', 
-                                            use_video_port=True):
-                                            
-        # Get timestamp for calculating actual framerate
-        timestamp = cv2.getTickCount()
-        
-        # Get Numpy array that represents the image
-        img = frame.array
-        
-        # Convert to RGB and encapsulate raw values into array for model input
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        features, cropped = runner.get_features_from_image(img_rgb)
+    # Preallocated frame buffers that get reused once we are done with them:
+    # 1 being captured, 1 waiting for inference, 1 in inference, 2 waiting for
+    # display, and 1 being displayed
+    free = Queue()
+    for _ in range(6):
+        free.put(np.empty((res_height, res_width, 3), dtype=np.uint8))
+
+    # Capture, inference, and display each run in their own thread so that
+    # they overlap. Capture keeps only the newest frame for inference, and
+    # inference can get up to 2 frames ahead of the display.
+    latest = Queue(maxsize=1)
+    results = Queue(maxsize=2)
+    stop_threads = threading.Event()
+    capture_thread = threading.Thread(target=capture_frames, 
+                                      args=(camera, free, latest, stop_threads), 
+                                      daemon=True)
+    infer_thread = threading.Thread(target=infer_frames, 
+                                    args=(runner, free, latest, results, stop_threads), 
+                                    daemon=True)
+    capture_thread.start()
+    infer_thread.start()
+    
+    # Get timestamp for calculating actual framerate
+    timestamp = cv2.getTickCount()
+
+    # Main while loop (display)
+    while running:
         
-        # Perform inference
-        res = None
+        # Wait for the next frame that has been through inference. Time out 
+        # now and then to check whether we have been asked to stop.
         try:
-            res = runner.classify(features)
-        except Exception as e:
-            print("ERROR: Could not perform inference")
-            print("Exception:", e)
-            
+            img, res = results.get(timeout=0.5)
+        except Empty:
+            continue
+        
         # Display predictions and timing data
         print("Output:", res)
         
@@ -117,19 +222,32 @@ with PiCamera() as camera:
                     1,
                     (255, 255, 255))
         
-        # Show the frame
-        cv2.imshow("Frame", img)
+        # Show the frame (OpenCV expects BGR, so use a channel-reversed view)
+        if display == "window":
+            cv2.imshow("Frame", img[:, :, ::-1])
+        elif display == "kms":
+            writer.write(img[:, :, ::-1])
         
-        # Clear the stream to prepare for next frame
-        raw_capture.truncate(0)
+        # Hand the frame buffer back to the capture thread for reuse
+        free.put(img)
         
-        # Calculate framrate
+        # Calculate framrate (time between displayed frames)
         frame_time = (cv2.getTickCount() - timestamp) / cv2.getTickFrequency()
         fps = 1 / frame_time
+        timestamp = cv2.getTickCount()
         
-        # Press 'q' to quit
-        if cv2.waitKey(1) == ord('q'):
+        # Press 'q' in the preview window to quit
+        if display == "window" and cv2.waitKey(1) == ord('q'):
             break
+    
+    # Stop the capture and inference threads before the camera is closed
+    # (don't wait long, in case one is stuck on the camera or the model)
+    stop_threads.set()
+    capture_thread.join(timeout=1)
+    infer_thread.join(timeout=1)
         
 # Clean up
-cv2.destroyAllWindows()
+if display == "window":
+    cv2.destroyAllWindows()
+elif display == "kms":
+    writer.release()